@@ -1,10 +0,0 @@
-from fastapi import FastAPI
-from howaboutno import HowAboutNo
-
-app = FastAPI()
-
-@app.get("/")
-def root():
-    return {
-        "message": "Hello, world!"
-    }
\ No newline at end of file
@@ -0,0 +1,21 @@
+from fastapi import FastAPI
+from howboutno import HowBoutNo
+
+app = FastAPI()
+
+@app.get("/")
+def root():
+    return {
+        "message": "Hello, world!"
+    }
+
+# Must be at the very end after all routes have been defined and after all other middleware have been added if there are any.
+app = HowBoutNo(app, config="config.toml")
+
+if __name__ == "__main__":
+    import importlib.util
+    import uvicorn
+
+    # uvloop and httptools replace the default asyncio event loop and HTTP parser with C implementations.
+    # uvloop isn't available on Windows, where uvicorn picks the default event loop instead.
+    uvicorn.run(app, loop="uvloop" if importlib.util.find_spec("uvloop") else "auto", http="httptools")
@@ -1,4 +1,4 @@
-from howaboutno import HowAboutNo
+from howboutno import HowBoutNo
 
 async def app(scope, receive, send):
     if scope["type"] == "http":
@@ -13,4 +13,15 @@ async def app(scope, receive, send):
         await send({
             "type": "http.response.body",
             "body": b"Hello, world!",
-        })
\ No newline at end of file
+        })
+
+# Must be at the very end after all routes have been defined and after all other middleware have been added if there are any.
+app = HowBoutNo(app, config="config.toml")
+
+if __name__ == "__main__":
+    import importlib.util
+    import uvicorn
+
+    # uvloop and httptools replace the default asyncio event loop and HTTP parser with C implementations.
+    # uvloop isn't available on Windows, where uvicorn picks the default event loop instead.
+    uvicorn.run(app, loop="uvloop" if importlib.util.find_spec("uvloop") else "auto", http="httptools")
@@ -1,6 +1,61 @@
+from functools import lru_cache
+from pathlib import Path
+import tomllib
+from .model import config_
+
+# The sample config as Python literals, mirroring the TOML written by create_config()
+DEFAULT_CONFIG_DICT = {
+    "block_ip": {"block_ip": ["1.1.1.1", "2.2.2.2"]},
+    "block_continent": {"block_continent": ["AS", "EU"]},
+    "block_country": {"block_country": ["IN", "CN"]},
+    "block_asn": {"block_asn": [12345, 67890]},
+    "block_rdns_hostname": {"block_rdns_hostname": ["badhost.example.com", "malicious.example.net"]},
+    "allow_hosting": {"allow_hosting": False},
+    "allow_proxy": {"allow_proxy": False},
+    "exception_ip": {"exception_ip": ["3.3.3.3"]},
+    "exception_path": {"exception_path": ["/health", "/status"]},
+    "response": {
+        "ip": {
+            "response": "{\"detail\": \"Access denied due to your IP address.\"}",
+            "status_code": 403,
+            "return_as": "JSON"
+        },
+        "all": {
+            "response": "<h1>Access Denied</h1><p>Your request has been blocked.</p>",
+            "status_code": 403,
+            "return_as": "HTML"
+        }
+    },
+    "cache": {
+        "size": 512,
+        "invalidate_success_after": 604800,
+        "invalidate_error_after": 3600
+    },
+    "disable_logging": {"disable_logging": False}
+}
+
+def default_config() -> config_:
+    """
+    Build the sample config directly from Python literals, without writing or parsing a TOML file.
+    """
+    return config_.model_validate(DEFAULT_CONFIG_DICT)
+
+@lru_cache(maxsize=8)
+def _load_config(path: str, mtime_ns: int, size: int) -> config_:
+    return config_.model_validate(tomllib.loads(Path(path).read_text()))
+
+def parse_config(path: str | Path) -> config_:
+    """
+    Parse and validate a TOML config file. Results are memoized on the file's path, modification time and size,
+    so a file is only parsed again after it changes. The validated config is frozen, so every caller can safely share it.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    return _load_config(str(path), stat.st_mtime_ns, stat.st_size)
+
 def create_config():
-    config_content = """
-# Block IPs (both IPv4 and IPv6 supported)
+    config_content = r"""
+# Block IPs and CIDR networks (both IPv4 and IPv6 supported)
 [block_ip]
 block_ip = ["1.1.1.1", "2.2.2.2"]
 
@@ -16,7 +71,7 @@ block_country = ["IN", "CN"]
 [block_asn]
 block_asn = [12345, 67890]
 
-# Block reverse DNS hostnames
+# Block reverse DNS hostnames (subdomains of a listed hostname are blocked too)
 [block_rdns_hostname]
 block_rdns_hostname = ["badhost.example.com", "malicious.example.net"]
 
@@ -28,11 +83,11 @@ allow_hosting = false
 [allow_proxy]
 allow_proxy = false
 
-# Exception IPs (list of IP addresses to exclude from blocking)
+# Exception IPs (list of IP addresses and CIDR networks to exclude from blocking)
 [exception_ip]
 exception_ip = ["3.3.3.3"]
 
-# Exception paths (list of URL paths to exclude from blocking)
+# Exception paths (list of URL paths to exclude from blocking, including everything below them)
 [exception_path]
 exception_path = ["/health", "/status"]
 
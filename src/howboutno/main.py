@@ -2,88 +2,385 @@ from beartype import beartype
 import asyncio
 import httpx
 import time
+import math
+import random
 from pathlib import Path
-import tomllib
-from cachetools import LRUCache
-from .model import config_
-import json
+from cachetools import TLRUCache
+from .model import config_, ip_to_int, IPSet, json_loads, json_dumps
+from pydantic import ValidationError
+from .create_config import parse_config
 import ipaddress
+from typing import NamedTuple
+from functools import lru_cache
+
+try:
+    from httpx_aiohttp import AiohttpTransport
+except ImportError:
+    AiohttpTransport = None
+
+try:
+    from aiolimiter import AsyncLimiter
+except ImportError:
+    AsyncLimiter = None
+
+class CacheEntry(NamedTuple):
+    """
+    An ip-api.com lookup result as stored in the cache. A flat tuple takes a fraction
+    of the memory of the nested dicts it replaces.
+    """
+    status_code: int
+    response: dict | None
+    # The ASN parsed from the response's "as" field (e.g. "AS15169 Google LLC"), if there is one
+    asn: int | None = None
+    # The (sender, label) of the first block rule a successful lookup matches, decided once when it's cached
+    block: tuple | None = None
+
+# The 503 sent when a client can't be checked. Like the block responses, the body is built once and each response
+# gets fresh copies of the messages, since outer middleware may add headers to the list it's given.
+_SERVICE_UNAVAILABLE_HEADERS = ((b'content-type', b'application/json'),)
+_SERVICE_UNAVAILABLE_START = {
+    'type': 'http.response.start',
+    'status': 503,
+}
+_SERVICE_UNAVAILABLE_BODY = {
+    'type': 'http.response.body',
+    'body': json_dumps({"detail": "Service Unavailable"}),
+}
+_RETRY_AFTER = b'retry-after'
+
+# ip-api.com's free tier allows 45 lookups per minute. A request that would start a lookup past that gets a 503 instead of
+# queueing, with Retry-After set to the time it takes the limiter to free one more lookup.
+_LOOKUP_RATE = 45
+_LOOKUP_PERIOD = 60
+_LOOKUP_RETRY_AFTER = b"%d" % math.ceil(_LOOKUP_PERIOD / _LOOKUP_RATE)
+# How long a request may wait for the limiter when it reported capacity but another request took it first
+_LOOKUP_WAIT = 1.0
+
+# Without a lifespan, a failed blocklist download is retried by a request no sooner than this many seconds later.
+# Requests in between get a 503 straight away rather than each starting another multi-MB download.
+_BOOTSTRAP_RETRY_DELAY = 60
+
+# ip-api.com query string, built once and passed to every lookup
+_IP_API_PARAMS = httpx.QueryParams({"fields": "status,continentCode,countryCode,as,reverse,proxy,hosting"})
+
+def _jittered_ttu(success_ttl: float, error_ttl: float):
+    """
+    Build a TLRUCache time-to-use function that gives successful lookups success_ttl and failed ones error_ttl,
+    spread over ±15% so entries cached together don't all expire and hit ip-api.com in the same instant.
+    """
+    def ttu(key, value, now):
+        ttl = success_ttl if value.status_code == 200 else error_ttl
+        return now + ttl * random.uniform(0.85, 1.15)
+
+    return ttu
+
+@lru_cache(maxsize=8192)
+def _parse_client(client: str) -> tuple[str, int, bool]:
+    """
+    Parse a client address once into its normalized string, its ip_to_int() integer and whether
+    it's private or reserved. Results are cached, so repeat clients skip ipaddress entirely.
+    """
+    address = ipaddress.ip_address(client)
+    return str(address), ip_to_int(client), address.is_private or address.is_reserved
 
 class HowBoutNo():
     @beartype
-    def __init__(self, app, config: str | None = None):
+    def __init__(self, app, config: str | config_ | None = None):
         self.app = app
 
-        if config:
+        if isinstance(config, config_):
+            self.config = config
+        elif config:
             path = Path(config)
             if not path.exists():
                 raise Exception(f"The given config file ({config}) couldn't be found. Make sure it exists in the current working directory.")
             if not path.is_file():
                 raise Exception(f"{config} is not a file.")
             try:
-                config = tomllib.loads(path.read_text())
+                self.config = parse_config(path)
+            except ValidationError:
+                raise
             except Exception:
                 raise Exception(f"Couldn't parse TOML.")
-
-            self.config = config_.model_validate(config)
         else:
             self.config = None
 
         if self.config:
+            # One cache of at most cache.size lookups, where successful and failed lookups expire after different, jittered times.
+            # An invalidation time of 0 means never. Expiry runs on the monotonic clock so wall clock adjustments can't expire entries early or late.
             cache_size = self.config.cache.size
-            self.cache = LRUCache(maxsize=cache_size)
+            self.cache = TLRUCache(
+                maxsize=cache_size,
+                ttu=_jittered_ttu(self.config.cache.invalidate_success_after or math.inf, self.config.cache.invalidate_error_after or math.inf),
+                timer=time.monotonic
+            )
+
+            # One long-lived client so ip-api.com lookups reuse pooled keep-alive connections.
+            # I/O goes through aiohttp when httpx-aiohttp is installed, which holds up better under many concurrent lookups.
+            # At most 10 lookups in flight, and when aiolimiter is installed, no more lookups than ip-api.com's free tier allows,
+            # so bursts of new IPs don't run past the limit before the X-Rl header can report it.
+            # All three belong to an event loop, so they're created by _bind_loop() once one is running.
+            self._client = None
+            self._client_loop = None
+            self._lookup_semaphore = None
+            self._lookup_limiter = None
+            # Lookups currently in flight by IP, so concurrent cache misses for one IP share a single request
+            self._inflight = {}
+
+            # The blocklists are fetched on lifespan startup, or on the first request if the server doesn't run lifespan
+            self.inbound_bad_ip_list = IPSet()
+            self.outbound_bad_ip_list = IPSet()
+            self._bootstrapped = not (self.config.block_bad_ip.block_inbound_bad_ip or self.config.block_bad_ip.block_outbound_bad_ip)
+            self._bootstrap_task = None
+            self._bootstrap_retry_at = 0.0
+
+            # Block rules as (predicate, response, label), checked in this order against an IP's lookup data.
+            # Rules that can never match with this config are left out, and response.all overrides every response.
+            config = self.config
+            responses = config.response
+            rules = [
+                (config.block_bad_ip.block_inbound_bad_ip, lambda lookup: lookup["ip_int"] in self.inbound_bad_ip_list, responses.bad_ip, "inbound bad IP"),
+                (config.block_bad_ip.block_outbound_bad_ip, lambda lookup: lookup["ip_int"] in self.outbound_bad_ip_list, responses.bad_ip, "outbound bad IP"),
+                (config.block_continent.block_continent, lambda lookup, contains=config.block_continent.contains: contains(lookup["continent"]), responses.continent, "continent"),
+                (config.block_country.block_country, lambda lookup, contains=config.block_country.contains: contains(lookup["country"]), responses.country, "country"),
+                (config.block_asn.block_asn, lambda lookup, contains=config.block_asn.contains: contains(lookup["asn"]), responses.asn, "ASN"),
+                (config.block_rdns_hostname.block_rdns_hostname, lambda lookup, matches=config.block_rdns_hostname.matches: matches(lookup["rdns_hostname"]), responses.rdns_hostname, "RDNS hostname"),
+                (not config.allow_hosting.allow_hosting, lambda lookup: lookup["hosting"], responses.hosting, "hosting"),
+                (not config.allow_proxy.allow_proxy, lambda lookup: lookup["proxy"], responses.proxy, "proxy"),
+            ]
+            # Each rule's response is turned into its ASGI sender here, once, since senders can be reused across requests
+            self._rules = [(predicate, (responses.all or response).get_response_obj(), label) for enabled, predicate, response, label in rules if enabled]
+
+            # Config lookups needed on every request, bound once so requests don't walk the config models
+            self._exception_ip = config.exception_ip.contains
+            self._exception_path = config.exception_path.match
+            self._block_ip = config.block_ip.contains
+            self._block_ip_response = (responses.all or responses.ip).get_response_obj()
+            self._log_blocks = not config.disable_logging.disable_logging
+
+        self.reset = 0
+
+    async def _fetch_bad_ip_list(self, url):
+        """
+        Stream a blocklist into an IPSet line by line, so the whole file is never held in memory at once.
+        Blank lines, comments and lines that aren't an IP address or network are skipped.
+        """
+        bad_ip_list = IPSet()
+        async with self._bind_loop().stream("GET", url, timeout=httpx.Timeout(30.0)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    bad_ip_list.add(line)
+                except ValueError:
+                    continue
+        return bad_ip_list
+
+    async def _fetch_inbound(self):
+        print("Fetching inbound IP blacklist data...")
+        self.inbound_bad_ip_list = await self._fetch_bad_ip_list("https://raw.githubusercontent.com/bitwire-it/ipblocklist/main/inbound.txt")
+
+    async def _fetch_outbound(self):
+        print("Fetching outbound IP blocklist data...")
+        self.outbound_bad_ip_list = await self._fetch_bad_ip_list("https://raw.githubusercontent.com/bitwire-it/ipblocklist/main/outbound.txt")
+
+    async def _bootstrap(self):
+        """
+        Fetch the enabled blocklists concurrently. Concurrent callers share one fetch,
+        and a failed fetch is retried by the first caller after _BOOTSTRAP_RETRY_DELAY has passed.
+        """
+        if self._bootstrapped:
+            return
 
+        if self._bootstrap_task is None:
+            if time.monotonic() < self._bootstrap_retry_at:
+                raise RuntimeError("The bad IP blocklists failed to download and aren't due to be retried yet.")
+            fetches = []
             if self.config.block_bad_ip.block_inbound_bad_ip:
-                print("Fetching inbound IP blacklist data...")
-                inbound_bad_ip = httpx.get("https://raw.githubusercontent.com/bitwire-it/ipblocklist/main/inbound.txt", timeout=httpx.Timeout(30.0))
-                self.inbound_bad_ip_list = set(inbound_bad_ip.text.splitlines())
+                fetches.append(self._fetch_inbound())
             if self.config.block_bad_ip.block_outbound_bad_ip:
-                print("Fetching outbound IP blocklist data...")
-                outbound_bad_ip = httpx.get("https://raw.githubusercontent.com/bitwire-it/ipblocklist/main/outbound.txt", timeout=httpx.Timeout(30.0))
-                self.outbound_bad_ip_list = set(outbound_bad_ip.text.splitlines())
-            
-        self.reset = 0
+                fetches.append(self._fetch_outbound())
+            self._bootstrap_task = asyncio.ensure_future(asyncio.gather(*fetches))
+
+        task = self._bootstrap_task
+        try:
+            # Shielded so one cancelled caller doesn't cancel the fetch for everyone else
+            await asyncio.shield(task)
+        except Exception as e:
+            # Only the caller that clears the failed fetch reports it and schedules the retry
+            if self._bootstrap_task is task and task.done():
+                self._bootstrap_task = None
+                self._bootstrap_retry_at = time.monotonic() + _BOOTSTRAP_RETRY_DELAY
+                print(f"Couldn't fetch the bad IP blocklists, retrying in {_BOOTSTRAP_RETRY_DELAY} seconds: {e!r}")
+            raise
+
+        self._bootstrapped = True
+
+    async def _fetch_ip(self, ip):
+        async with self._lookup_semaphore:
+            return await self._client.get(f"http://ip-api.com/json/{ip}", params=_IP_API_PARAMS)
+
+    async def _acquire_lookup(self):
+        """
+        Take one lookup from the rate limiter without queueing behind other requests. Returns False if none is available.
+        """
+        if self._lookup_limiter is None:
+            return True
+        if not self._lookup_limiter.has_capacity():
+            return False
+        try:
+            async with asyncio.timeout(_LOOKUP_WAIT):
+                await self._lookup_limiter.acquire()
+        except TimeoutError:
+            return False
+        return True
+
+    async def _lookup_ip(self, ip):
+        """
+        Look up an IP on ip-api.com, joining the lookup already in flight for it if there is one.
+        Returns None if a new lookup is needed but the rate limiter has none to spare.
+        """
+        self._bind_loop()
+        task = self._inflight.get(ip)
+        if task is None:
+            # The limiter is taken by the request itself, so requests that give up never spend ip-api.com's budget
+            if not await self._acquire_lookup():
+                return None
+            # Another request may have started a lookup for this IP while this one was acquiring
+            task = self._inflight.get(ip)
+        if task is None:
+            task = self._inflight[ip] = asyncio.ensure_future(self._fetch_ip(ip))
+            task.add_done_callback(lambda _: self._inflight.pop(ip, None))
+        # Shielded so one cancelled request doesn't cancel the lookup for the others waiting on it
+        return await asyncio.shield(task)
+
+    def _decide(self, ip, ip_int, entry):
+        """
+        Return (sender, label) for the first block rule a successful lookup matches, or None if it matches none.
+        """
+        lookup = {
+            "ip": ip,
+            "ip_int": ip_int,
+            "continent": entry.response["continentCode"],
+            "country": entry.response["countryCode"],
+            "asn": entry.asn,
+            "rdns_hostname": entry.response["reverse"],
+            "hosting": entry.response["hosting"],
+            "proxy": entry.response["proxy"]
+        }
+
+        for predicate, block_response, label in self._rules:
+            if predicate(lookup):
+                return (block_response, label)
+        return None
+
+    @staticmethod
+    async def _send_503(send, extra_headers=None):
+        # The two sends stay sequential, since ASGI requires the start message to be sent before the body
+        await send({**_SERVICE_UNAVAILABLE_START, 'headers': [*_SERVICE_UNAVAILABLE_HEADERS, *(extra_headers or ())]})
+        await send({**_SERVICE_UNAVAILABLE_BODY})
+
+    @staticmethod
+    def _new_client():
+        limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0),
+            limits=limits,
+            transport=AiohttpTransport(limits=limits) if AiohttpTransport else None
+        )
+
+    def _bind_loop(self):
+        """
+        Return the shared HTTP client, creating it and the lookup limits for the running event loop if needed.
+        A client closed by a lifespan shutdown is replaced, and a new loop gets its own client and limits,
+        so the app can be started up again (e.g. once per TestClient block).
+        """
+        loop = asyncio.get_running_loop()
+        if self._client_loop is not loop:
+            self._client_loop = loop
+            self._client = None
+            self._lookup_semaphore = asyncio.Semaphore(10)
+            self._lookup_limiter = AsyncLimiter(_LOOKUP_RATE, _LOOKUP_PERIOD) if AsyncLimiter else None
+        if self._client is None or self._client.is_closed:
+            self._client = self._new_client()
+        return self._client
+
+    @staticmethod
+    def _cache_put(cache, ip, entry):
+        # A cache size of 0 disables caching
+        if cache.maxsize:
+            cache[ip] = entry
+
+    def _lifespan(self, receive, send):
+        """
+        Wrap the lifespan channels so the blocklists are fetched once the app has started up
+        and the shared HTTP client is closed when it shuts down. If the blocklists can't be fetched,
+        startup is reported as failed instead of complete.
+        """
+        async def wrapped_receive():
+            message = await receive()
+            if message["type"] == "lifespan.shutdown" and self._client is not None:
+                await self._client.aclose()
+            return message
+
+        async def wrapped_send(message):
+            if message["type"] == "lifespan.startup.complete":
+                try:
+                    await self._bootstrap()
+                except Exception as e:
+                    return await send({"type": "lifespan.startup.failed", "message": f"Couldn't fetch the bad IP blocklists: {e!r}"})
+            return await send(message)
+
+        return wrapped_receive, wrapped_send
 
     async def __call__(self, scope, receive, send):
 
+        if scope["type"] == "lifespan" and self.config:
+            return await self.app(scope, *self._lifespan(receive, send))
+
         if scope["type"] != "http" or not self.config:
             return await self.app(scope, receive, send)
 
-        async def block_response_logger(obj, type):
-            if not self.config.disable_logging.disable_logging:
-                print(f"Blocked '{ip}' from accessing '{path}' based on {type} block condition.")
-            return await obj(send)
-        
         # Normalize IP
-        ip = str(ipaddress.ip_address(scope["client"][0]))
+        ip, ip_int, is_local = _parse_client(scope["client"][0])
         path = scope.get("path")
 
+        # Excepted IPs and paths bypass every block rule, so they don't need a lookup either
+        if self._exception_ip(ip_int) or self._exception_path(path):
+            return await self.app(scope, receive, send)
 
-        if ip in self.config.block_ip:
-            all_block_response = self.config.response.all.get_response_obj() if self.config.response.all else self.config.response.ip.get_response_obj()
-            return await all_block_response(send)
-
-        if ipaddress.ip_address(ip).is_private or ipaddress.ip_address(ip).is_reserved:
-            await send({
-                'type': 'http.response.start',
-                'status': 503,
-                'headers': [
-                    [b'content-type', b'application/json'],
-                ],
-            })
-            await send({
-                'type': 'http.response.body',
-                'body': json.dumps({"detail": "Service Unavailable"}).encode(),
-            })
-            return
-        
-        cache_config_invalidate_success_after = self.config.cache.invalidate_success_after
-        cache_config_invalidate_error_after = self.config.cache.invalidate_error_after
+        if self._block_ip(ip_int):
+            return await self._block_ip_response(send)
+
+        if is_local:
+            return await self._send_503(send)
+
+        # Only requests that go through the block rules need the blocklists
+        if not self._bootstrapped:
+            try:
+                await self._bootstrap()
+            except Exception:
+                # The request can't be checked without the blocklists, so it's turned away until the retry is due
+                retry_after = max(1, math.ceil(self._bootstrap_retry_at - time.monotonic()))
+                return await self._send_503(send, ((_RETRY_AFTER, b"%d" % retry_after),))
 
-        cache_entry = self.cache.get(ip)
-        in_cache = bool(cache_entry)
+        entry = self.cache.get(ip)
+
+        if entry is None:
+            # The rate limit reset runs on the monotonic clock, so wall clock adjustments can't end it early or late
+            now = time.monotonic()
+
+            if now < self.reset:
+                # Retry-After takes the seconds left until the rate limit resets, rounded up
+                retry_after = math.ceil(self.reset - now)
+                return await self._send_503(send, ((_RETRY_AFTER, b"%d" % retry_after),))
+        
+            response = await self._lookup_ip(ip)
+            if response is None:
+                return await self._send_503(send, ((_RETRY_AFTER, _LOOKUP_RETRY_AFTER),))
 
-        if in_cache:
             """
             We are classifying cache entries as successful if the status code of the response is 200,
             and unsuccessful otherwise. The response body from ip-api.com has a 'status' field which
@@ -108,206 +405,46 @@ class HowBoutNo():
             reserved, private and invalid IPs.Therefore, we should not include the 'status' field in the
             classification and only rely on the status code of the response.
             """
-            is_successful_cache = cache_entry["data"]["status_code"] == 200
-            success_cache_invalidate_time = cache_entry["last_updated"] + cache_config_invalidate_success_after
-            error_cache_invalidate_time = cache_entry["last_updated"] + cache_config_invalidate_error_after
-
-        if not in_cache or (is_successful_cache and time.time() >= success_cache_invalidate_time and cache_config_invalidate_success_after != 0) or (not is_successful_cache and time.time() >= error_cache_invalidate_time and cache_config_invalidate_error_after != 0):
-            rate_limited = False if time.time() >= self.reset else True
-
-            if rate_limited:
-                await send({
-                    'type': 'http.response.start',
-                    'status': 503,
-                    'headers': [
-                        [b'content-type', b'application/json'],
-                        [b'Retry-After', str(self.reset).encode()]
-                    ],
-                })
-                await send({
-                    'type': 'http.response.body',
-                    'body': json.dumps({"detail": "Service Unavailable"}).encode(),
-                })
-                return
-        
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"http://ip-api.com/json/{ip}?fields=status,continentCode,countryCode,as,reverse,proxy,hosting")
-
             if response.status_code != 200:
-                self.cache[ip] = {
-                    "data": {
-                        "status_code": response.status_code,
-                        "response": response.json() if response.content else None
-
-                    },
-                    "last_updated": time.time()
-                }
-
-                await send({
-                    'type': 'http.response.start',
-                    'status': 503,
-                    'headers': [
-                        [b'content-type', b'application/json'],
-                    ],
-                })
-                await send({
-                    'type': 'http.response.body',
-                    'body': json.dumps({"detail": "Service Unavailable"}).encode(),
-                })
-                return
+                # Error bodies aren't guaranteed to be JSON (e.g. a proxy's HTML error page)
+                try:
+                    error_json = json_loads(response.content) if response.content else None
+                except ValueError:
+                    error_json = None
+
+                self._cache_put(self.cache, ip, CacheEntry(
+                    status_code=response.status_code,
+                    response=error_json
+                ))
 
+                return await self._send_503(send)
+
+            # X-Rl is the number of requests left in the current window and X-Ttl the seconds until it resets
             if response.headers["X-Rl"] == "0":
-                rate_limited = True
-                self.reset = time.time() + response.headers["X-Ttl"]
+                self.reset = time.monotonic() + int(response.headers["X-Ttl"])
 
-            response_json = response.json()
+            response_json = json_loads(response.content)
 
             if response_json["status"] != "success":
-                await send({
-                    'type': 'http.response.start',
-                    'status': 503,
-                    'headers': [
-                        [b'content-type', b'application/json'],
-                    ],
-                })
-                await send({
-                    'type': 'http.response.body',
-                    'body': json.dumps({"detail": "Service Unavailable"}).encode(),
-                })
-                return
+                return await self._send_503(send)
             
-            self.cache[ip] = {
-                "data": {
-                    "status_code": response.status_code,
-                    "response": response.json() if response.content else None
-
-                },
-                "last_updated": time.time()
-            }
-
-            continent = response_json["continentCode"]
-            country = response_json["countryCode"]
-            asn = int(response_json["as"].split(" ")[0][2:]) if response_json["as"] else response_json["as"]
-            rdns_hostname = response_json["reverse"]
-            is_hosting = response_json["hosting"]
-            is_proxy = response_json["proxy"]
-
-            if self.config.response.all:
-                all_block_response = self.config.response.all.get_response_obj()
-
-                if self.config.block_bad_ip.block_inbound_bad_ip and ip in self.inbound_bad_ip_list and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                    return await block_response_logger(all_block_response, "inbound bad IP")
-                if self.config.block_bad_ip.block_outbound_bad_ip and ip in self.outbound_bad_ip_list and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                    return await block_response_logger(all_block_response, "outbound bad IP")
-                if continent in self.config.block_continent.block_continent and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                    return await block_response_logger(all_block_response, "continent")
-                if country in self.config.block_country.block_country and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                    return await block_response_logger(all_block_response, "country")
-                if asn in self.config.block_asn.block_asn and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                    return await block_response_logger(all_block_response, "ASN")
-                if rdns_hostname in self.config.block_rdns_hostname.block_rdns_hostname and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                    return await block_response_logger(all_block_response, "RDNS hostname")
-                if not self.config.allow_hosting.allow_hosting and is_hosting and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                    return await block_response_logger(all_block_response, "hosting")
-                if not self.config.allow_proxy.allow_proxy and is_proxy and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                    return await block_response_logger(all_block_response, "proxy")
-
-                return await self.app(scope, receive, send)
-
-            continent_response = self.config.response.continent.get_response_obj()
-            country_response = self.config.response.country.get_response_obj()
-            asn_response = self.config.response.asn.get_response_obj()
-            rdns_hostname_response = self.config.response.rdns_hostname.get_response_obj()
-            hosting_response = self.config.response.hosting.get_response_obj()
-            proxy_response = self.config.response.proxy.get_response_obj()
-
-            if self.config.block_bad_ip.block_inbound_bad_ip and ip in self.inbound_bad_ip_list and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(self.config.response.bad_ip.get_response_obj(), "inbound bad IP")
-            if self.config.block_bad_ip.block_outbound_bad_ip and ip in self.outbound_bad_ip_list and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(self.config.response.bad_ip.get_response_obj(), "outbound bad IP")
-            if continent in self.config.block_continent.block_continent and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(continent_response, "continent")
-            if country in self.config.block_country.block_country and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(country_response, "country")
-            if asn in self.config.block_asn.block_asn and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(asn_response, "ASN")
-            if rdns_hostname in self.config.block_rdns_hostname.block_rdns_hostname and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(rdns_hostname_response, "RDNS hostname")
-            if not self.config.allow_hosting.allow_hosting and is_hosting and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(hosting_response, "hosting")
-            if not self.config.allow_proxy.allow_proxy and is_proxy and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(proxy_response, "proxy")
-
-            return await self.app(scope, receive, send)
-
-
-        cache = self.cache[ip]
-
-        continent = cache["data"]["response"]["continentCode"]
-        country = cache["data"]["response"]["countryCode"]
-        asn = int(cache["data"]["response"]["as"].split(" ")[0][2:]) if cache["data"]["response"]["as"] else None
-        rdns_hostname = cache["data"]["response"]["reverse"]
-        is_hosting = cache["data"]["response"]["hosting"]
-        is_proxy = cache["data"]["response"]["proxy"]
-
-        if cache["data"]["status_code"] != 200 or cache["data"]["response"]["status"] != "success":
-            await send({
-                'type': 'http.response.start',
-                'status': 503,
-                'headers': [
-                    [b'content-type', b'application/json'],
-                ],
-            })
-            await send({
-                'type': 'http.response.body',
-                'body': json.dumps({"detail": "Service Unavailable"}).encode(),
-            })
-            return
-
-        if self.config.response.all:
-            all_block_response = self.config.response.all.get_response_obj()
-
-            if self.config.block_bad_ip.block_inbound_bad_ip and ip in self.inbound_bad_ip_list and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(all_block_response, "inbound bad IP")
-            if self.config.block_bad_ip.block_outbound_bad_ip and ip in self.outbound_bad_ip_list and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(all_block_response, "outbound bad IP")
-            if continent in self.config.block_continent.block_continent and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(all_block_response, "continent")
-            if country in self.config.block_country.block_country and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(all_block_response, "country")
-            if asn in self.config.block_asn.block_asn and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(all_block_response, "ASN")
-            if rdns_hostname in self.config.block_rdns_hostname.block_rdns_hostname and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(all_block_response, "RDNS hostname")
-            if not self.config.allow_hosting.allow_hosting and is_hosting and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(all_block_response, "hosting")
-            if not self.config.allow_proxy.allow_proxy and is_proxy and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-                return await block_response_logger(all_block_response, "proxy")
-
-            return await self.app(scope, receive, send)
-
-        continent_response = self.config.response.continent.get_response_obj()
-        country_response = self.config.response.country.get_response_obj()
-        asn_response = self.config.response.asn.get_response_obj()
-        rdns_hostname_response = self.config.response.rdns_hostname.get_response_obj()
-        hosting_response = self.config.response.hosting.get_response_obj()
-        proxy_response = self.config.response.proxy.get_response_obj()
-
-        if self.config.block_bad_ip.block_inbound_bad_ip and ip in self.inbound_bad_ip_list and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-            return await block_response_logger(self.config.response.bad_ip.get_response_obj(), "inbound bad IP")
-        if self.config.block_bad_ip.block_outbound_bad_ip and ip in self.outbound_bad_ip_list and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-            return await block_response_logger(self.config.response.bad_ip.get_response_obj(), "outbound bad IP")
-        if continent in self.config.block_continent.block_continent and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-            return await block_response_logger(continent_response, "continent")
-        if country in self.config.block_country.block_country and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-            return await block_response_logger(country_response, "country")
-        if asn in self.config.block_asn.block_asn and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-            return await block_response_logger(asn_response, "ASN")
-        if rdns_hostname in self.config.block_rdns_hostname.block_rdns_hostname and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-            return await block_response_logger(rdns_hostname_response, "RDNS hostname")
-        if not self.config.allow_hosting.allow_hosting and is_hosting and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-            return await block_response_logger(hosting_response, "hosting")
-        if not self.config.allow_proxy.allow_proxy and is_proxy and ip not in self.config.exception_ip.exception_ip and path not in self.config.exception_path:
-            return await block_response_logger(proxy_response, "proxy")
+            entry = CacheEntry(
+                status_code=response.status_code,
+                response=response_json,
+                asn=int(response_json["as"].split(" ", 1)[0][2:]) if response_json["as"] else None
+            )
+            # The decision is stored with the lookup, so it's made once per lookup and expires along with it
+            entry = entry._replace(block=self._decide(ip, ip_int, entry))
+            self._cache_put(self.cache, ip, entry)
+
+        elif entry.status_code != 200 or entry.response["status"] != "success":
+            return await self._send_503(send)
+
+        # Fresh and cached lookups both end up here, so blocks are sent in one place
+        if entry.block:
+            block_response, label = entry.block
+            if self._log_blocks:
+                print(f"Blocked '{ip}' from accessing '{path}' based on {label} block condition.")
+            return await block_response(send)
 
         return await self.app(scope, receive, send)
@@ -1,230 +1,409 @@
-from pydantic import BaseModel, field_validator, model_validator, IPvAnyAddress
-import json
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, field_validator, model_validator, IPvAnyAddress
 from http import HTTPStatus
 from typing import Any
+from functools import lru_cache
 import ipaddress
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+def json_loads(data: str | bytes) -> Any:
+    """
+    Parse a JSON document, using orjson when it is installed.
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj: Any) -> bytes:
+    """
+    Serialize an object to UTF-8 encoded JSON bytes, using orjson when it is installed.
+    Values that aren't natively serializable are converted with str().
+    """
+    if orjson:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, default=str).encode()
+
+def _pack_address(address: ipaddress.IPv4Address | ipaddress.IPv6Address) -> int:
+    """
+    Pack a parsed IPv4 or IPv6 address into a single integer. IPv4 addresses are mapped into
+    the IPv4-mapped IPv6 range (::ffff:0:0/96) so they can't collide with IPv6 addresses.
+    """
+    if address.version == 4:
+        return int(address) | 0xFFFF00000000
+    return int(address)
+
+@lru_cache(maxsize=8192)
+def ip_to_int(ip: str) -> int:
+    """
+    Pack an IPv4 or IPv6 address string with _pack_address(). Results are cached, since the same
+    clients tend to make repeated requests.
+    """
+    return _pack_address(ipaddress.ip_address(ip))
+
+class IPSet():
+    """
+    A set of IP addresses and CIDR networks, queried with integers packed by ip_to_int().
+    Single addresses are kept in a plain set. Networks are grouped by prefix length, so a
+    lookup costs one integer set probe per distinct prefix length.
+    """
+    def __init__(self, entries=()):
+        self.addresses = set()
+        self.networks = {}
+
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry: str):
+        entry = entry.strip()
+        # Plain addresses skip the slower network parse
+        if "/" not in entry:
+            self.addresses.add(_pack_address(ipaddress.ip_address(entry)))
+            return
+
+        network = ipaddress.ip_network(entry, strict=False)
+        # Packed directly rather than through ip_to_int(), so loading a list doesn't evict the cached client addresses
+        address = _pack_address(network.network_address)
+        # IPv4 networks live in the IPv4-mapped range, so their prefix is offset by 96 bits
+        prefixlen = network.prefixlen + 96 if network.version == 4 else network.prefixlen
+
+        if prefixlen == 128:
+            self.addresses.add(address)
+        else:
+            self.networks.setdefault(prefixlen, set()).add(address >> (128 - prefixlen))
+
+    def __contains__(self, ip: int) -> bool:
+        if ip in self.addresses:
+            return True
+        for prefixlen, networks in self.networks.items():
+            if ip >> (128 - prefixlen) in networks:
+                return True
+        return False
+
+    def __eq__(self, other):
+        if not isinstance(other, IPSet):
+            return NotImplemented
+        return self.addresses == other.addresses and self.networks == other.networks
+
+def _code_index(code: str) -> int | None:
+    """
+    Map a two-letter code (A-Z) such as a continent or country code to a bit position in 0-675.
+    """
+    if not code or len(code) != 2:
+        return None
+    first = ord(code[0]) - 65
+    second = ord(code[1]) - 65
+    if 0 <= first < 26 and 0 <= second < 26:
+        return first * 26 + second
+    return None
+
+def _code_mask(codes) -> int:
+    """
+    Pack two-letter codes into a bitmask with one bit per possible code.
+    """
+    mask = 0
+    for code in codes:
+        index = _code_index(code)
+        if index is None:
+            raise ValueError(f"\"{code}\" is not a two-letter code.")
+        mask |= 1 << index
+    return mask
+
+# Header pairs shared by every block response of the same return type, copied into a new list for each response
+_HEADERS = {
+    "JSON": ((b'content-type', b'application/json'),),
+    "HTML": ((b'content-type', b'text/html'),),
+    "TEXT": ((b'content-type', b'text/plain'),),
+}
+
+def _make_sender(status: int, headers: tuple, body: bytes):
+    """
+    Build a callable that sends a prebuilt response through an ASGI send channel.
+    The body and headers are built once, and each call sends fresh copies of the messages.
+    """
+    start_message = {
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    }
+    body_message = {
+        'type': 'http.response.body',
+        'body': body,
+    }
+
+    # Each send gets its own copy of the messages and header list, since middleware further out may modify them in place
+    async def send_response(send):
+        await send({**start_message, 'headers': list(headers)})
+        await send({**body_message})
+
+    return send_response
 
 class response_model_(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     response: str
     status_code: HTTPStatus
     return_as: str
 
-    @model_validator(mode="after")
-    def validate_return_type(self):
+    @field_validator("return_as", mode="before")
+    @classmethod
+    def validate_return_type(cls, value):
         """
         Normalize 'return_as' and verify that it is a supported return format.
         """
-        self.return_as = self.return_as.strip().upper()
+        if not isinstance(value, str):
+            return value
+
+        return_as = value.strip().upper()
 
-        if self.return_as not in ["JSON", "HTML", "TEXT"]:
+        if return_as not in {"JSON", "HTML", "TEXT"}:
             raise ValueError("\"return_as\" must be either JSON, HTML or TEXT.")
 
-        return self
+        return return_as
     
     def get_response_obj(self):
         """
         Convert the response string into a callable ASGI response object based on the specified return type.
+        The body and both ASGI messages are built once here, so sending a response only awaits two prebuilt dicts.
         """
-
-        class JSON():
-            def __init__(self, content, status_code):
-                self.content = content
-                self.status_code = status_code
-            
-            async def __call__(self, send):
-                await send({
-                    'type': 'http.response.start',
-                    'status': self.status_code,
-                    'headers': [
-                        [b'content-type', b'application/json'],
-                    ],
-                })          
-                await send({
-                    'type': 'http.response.body',
-                    'body': json.dumps(self.content).encode(),
-                })
-                return
-            
-        class HTML():
-            def __init__(self, content, status_code):
-                self.content = content
-                self.status_code = status_code
-            
-            async def __call__(self, send):
-                await send({
-                    'type': 'http.response.start',
-                    'status': self.status_code,
-                    'headers': [
-                        [b'content-type', b'text/html'],
-                    ],
-                })              
-                await send({
-                    'type': 'http.response.body',
-                    'body': self.content.encode(),
-                })
-                return
-
-        class TEXT():
-            def __init__(self, content, status_code):
-                self.content = content
-                self.status_code = status_code
-            
-            async def __call__(self, send):
-                await send({
-                    'type': 'http.response.start',
-                    'status': self.status_code,
-                    'headers': [
-                        [b'content-type', b'text/plain'],
-                    ],
-                })
-                await send({
-                    'type': 'http.response.body',
-                    'body': self.content.encode(),
-                })
-                return
-            
         if self.return_as == "JSON":
-            data = json.loads(self.response)
-            response_obj = JSON(content=data, status_code=self.status_code)
-            return response_obj
-        elif self.return_as == "HTML":
-            response_obj = HTML(content=self.response, status_code=self.status_code)
-            return response_obj
-        elif self.return_as == "TEXT":
-            response_obj = TEXT(content=self.response, status_code=self.status_code)
-            return response_obj
+            body = json_dumps(json_loads(self.response))
+        else:
+            body = self.response.encode()
+
+        return _make_sender(int(self.status_code), _HEADERS[self.return_as], body)
 
 class block_ip_(BaseModel):
-    block_ip: list = []
+    model_config = ConfigDict(frozen=True)
+
+    block_ip: frozenset[str] = frozenset()
+    _ip_set: IPSet = PrivateAttr(default_factory=IPSet)
 
     @field_validator("block_ip", mode="before")
     @classmethod
     def validate_ip_addresses(cls, value):
-        return [str(ipaddress.ip_address(ip.strip())) for ip in value]
+        return {str(ipaddress.ip_network(ip.strip(), strict=False)) for ip in value}
+
+    @model_validator(mode="after")
+    def build_ip_set(self):
+        """
+        Index the blocked addresses and networks for lookups by packed integer.
+        """
+        self._ip_set = IPSet(self.block_ip)
+        return self
+
+    def contains(self, ip: int) -> bool:
+        return ip in self._ip_set
     
 
 class block_continent_(BaseModel):
-    block_continent: list[str] = []
+    model_config = ConfigDict(frozen=True)
+
+    block_continent: frozenset[str] = frozenset()
+    _mask: int = PrivateAttr(default=0)
 
     @field_validator("block_continent", mode="before")
     @classmethod
     def normalize_continent_codes(cls, value):
-        return [code.strip().upper() for code in value]
+        return {code.strip().upper() for code in value}
+
+    @model_validator(mode="after")
+    def build_mask(self):
+        """
+        Pack the blocked continent codes into a bitmask.
+        """
+        self._mask = _code_mask(self.block_continent)
+        return self
+
+    def contains(self, code: str | None) -> bool:
+        index = _code_index(code)
+        return index is not None and (self._mask >> index) & 1 == 1
     
 class block_country_(BaseModel):
-    block_country: list[str] = []
+    model_config = ConfigDict(frozen=True)
+
+    block_country: frozenset[str] = frozenset()
+    _mask: int = PrivateAttr(default=0)
 
     @field_validator("block_country", mode="before")
     @classmethod
     def normalize_country_codes(cls, value):
-        return [code.strip().upper() for code in value]
+        return {code.strip().upper() for code in value}
+
+    @model_validator(mode="after")
+    def build_mask(self):
+        """
+        Pack the blocked country codes into a bitmask.
+        """
+        self._mask = _code_mask(self.block_country)
+        return self
+
+    def contains(self, code: str | None) -> bool:
+        index = _code_index(code)
+        return index is not None and (self._mask >> index) & 1 == 1
     
 class block_asn_(BaseModel):
-    block_asn: list[int] = []
+    model_config = ConfigDict(frozen=True)
+
+    block_asn: frozenset[int] = frozenset()
+
+    def contains(self, asn: int | None) -> bool:
+        return asn in self.block_asn
 
 class block_rdns_hostname_(BaseModel):
-    block_rdns_hostname: list[str] = []
+    model_config = ConfigDict(frozen=True)
+
+    block_rdns_hostname: frozenset[str] = frozenset()
+    _trie: dict = PrivateAttr(default_factory=dict)
 
     @field_validator("block_rdns_hostname", mode="before")
     @classmethod
     def normalize_hostnames(cls, value):
-        return [hostname.strip().lower() for hostname in value]
+        return {hostname.strip().lower().rstrip(".") for hostname in value}
+
+    @model_validator(mode="after")
+    def build_trie(self):
+        """
+        Build a trie keyed on the hostname labels in reverse order, so a hostname matches
+        a blocked hostname or any of its subdomains in a single walk.
+        """
+        for hostname in self.block_rdns_hostname:
+            node = self._trie
+            for label in reversed(hostname.split(".")):
+                node = node.setdefault(label, {})
+            node["$"] = True
+        return self
+
+    def matches(self, hostname: str | None) -> bool:
+        if not hostname:
+            return False
+        node = self._trie
+        for label in reversed(hostname.lower().rstrip(".").split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if "$" in node:
+                return True
+        return False
 
 class block_bad_ip_(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     block_inbound_bad_ip: bool = False
     block_outbound_bad_ip: bool = False
 
 class allow_hosting_(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     allow_hosting: bool = True
 
 class allow_proxy_(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     allow_proxy: bool = True
     
+# Default response shared by every block type that doesn't define its own.
+# Built with model_construct since the values are already in their validated form.
+_DEFAULT_FORBIDDEN = response_model_.model_construct(response="{\"detail\": \"Forbidden\"}", status_code=HTTPStatus.FORBIDDEN, return_as="JSON")
+
 class response_(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     all: response_model_ = None
-    ip: response_model_ = response_model_.model_validate(
-        {
-            "response": "{\"detail\": \"Forbidden\"}",
-            "status_code": 403,
-            "return_as": "JSON"
-        }
-    )
-    continent: response_model_ = response_model_.model_validate(
-        {
-            "response": "{\"detail\": \"Forbidden\"}",
-            "status_code": 403,
-            "return_as": "JSON"
-        }
-    )
-    country: response_model_ = response_model_.model_validate(
-        {
-            "response": "{\"detail\": \"Forbidden\"}",
-            "status_code": 403,
-            "return_as": "JSON"
-        }
-    )
-    asn: response_model_ = response_model_.model_validate(
-        {
-            "response": "{\"detail\": \"Forbidden\"}",
-            "status_code": 403,
-            "return_as": "JSON"
-        }
-    )
-    rdns_hostname: response_model_ = response_model_.model_validate(
-        {
-            "response": "{\"detail\": \"Forbidden\"}",
-            "status_code": 403,
-            "return_as": "JSON"
-        }
-    )
-
-    bad_ip: response_model_ = response_model_.model_validate(
-        {
-            "response": "{\"detail\": \"Forbidden\"}",
-            "status_code": 403,
-            "return_as": "JSON"
-        }
-    )
-    
-    hosting: response_model_ = response_model_(response="{\"detail\": \"Forbidden\"}", status_code=403, return_as="JSON")
-    proxy: response_model_ = response_model_(response="{\"detail\": \"Forbidden\"}", status_code=403, return_as="JSON")
+    ip: response_model_ = Field(default_factory=lambda: _DEFAULT_FORBIDDEN)
+    continent: response_model_ = Field(default_factory=lambda: _DEFAULT_FORBIDDEN)
+    country: response_model_ = Field(default_factory=lambda: _DEFAULT_FORBIDDEN)
+    asn: response_model_ = Field(default_factory=lambda: _DEFAULT_FORBIDDEN)
+    rdns_hostname: response_model_ = Field(default_factory=lambda: _DEFAULT_FORBIDDEN)
+    bad_ip: response_model_ = Field(default_factory=lambda: _DEFAULT_FORBIDDEN)
+    hosting: response_model_ = Field(default_factory=lambda: _DEFAULT_FORBIDDEN)
+    proxy: response_model_ = Field(default_factory=lambda: _DEFAULT_FORBIDDEN)
 
 class exception_path_(BaseModel):
-    exception_path: list[str] = []
+    model_config = ConfigDict(frozen=True)
+
+    exception_path: frozenset[str] = frozenset()
+    _pattern: re.Pattern | None = PrivateAttr(default=None)
 
     @field_validator("exception_path", mode="before")
     @classmethod
     def normalize_exception_paths(cls, value):
-        return [path.strip() for path in value]
+        paths = set()
+        for path in value:
+            path = path.strip()
+            # "/" covers every path, so an empty or relative entry mustn't quietly become it
+            if not path.startswith("/"):
+                raise ValueError(f"\"{path}\" is not an absolute URL path.")
+            paths.add(path.rstrip("/") or "/")
+        return paths
+
+    @model_validator(mode="after")
+    def compile_pattern(self):
+        """
+        Compile the exception paths into a single anchored regex matching each path and everything below it.
+        """
+        if self.exception_path:
+            # Longest paths first so "/a/b" is tried before "/a". The root is stored as "/" but compiles to an
+            # empty prefix, so like any other path it covers everything below it, which is every path.
+            paths = sorted((path.rstrip("/") for path in self.exception_path), key=len, reverse=True)
+            self._pattern = re.compile("(?:" + "|".join(re.escape(path) for path in paths) + ")(?:/|$)")
+        return self
+
+    def match(self, path: str) -> bool:
+        return self._pattern is not None and self._pattern.match(path) is not None
     
 class cache_(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     size: int = 512
     invalidate_success_after: int = 604800 # 7 days
     invalidate_error_after: int = 3600 # 1 hour
 
 class exception_ip_(BaseModel):
-    exception_ip: list = []
+    model_config = ConfigDict(frozen=True)
+
+    exception_ip: frozenset[str] = frozenset()
+    _ip_set: IPSet = PrivateAttr(default_factory=IPSet)
 
     @field_validator("exception_ip", mode="before")
     @classmethod
     def validate_exception_ip_addresses(cls, value):
-        return [str(ipaddress.ip_address(ip.strip())) for ip in value]
+        return {str(ipaddress.ip_network(ip.strip(), strict=False)) for ip in value}
+
+    @model_validator(mode="after")
+    def build_ip_set(self):
+        """
+        Index the excepted addresses and networks for lookups by packed integer.
+        """
+        self._ip_set = IPSet(self.exception_ip)
+        return self
+
+    def contains(self, ip: int) -> bool:
+        return ip in self._ip_set
     
 class disable_logging_(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     disable_logging: bool = False
     
 
 class config_(BaseModel):
-    block_ip: block_ip_ = block_ip_()
-    block_bad_ip: block_bad_ip_ = block_bad_ip_()
-    block_continent: block_continent_ = block_continent_()
-    block_country: block_country_ = block_country_()
-    block_asn: block_asn_ = block_asn_()
-    block_rdns_hostname: block_rdns_hostname_ = block_rdns_hostname_()
-    allow_hosting: allow_hosting_ = allow_hosting_()
-    allow_proxy: allow_proxy_ = allow_proxy_()
-    exception_ip: exception_ip_ = exception_ip_()
-    exception_path: exception_path_ = exception_path_()
-    response: response_ = response_()
-    cache: cache_ = cache_()
-    disable_logging: disable_logging_ = disable_logging_()
+    model_config = ConfigDict(frozen=True)
+
+    block_ip: block_ip_ = Field(default_factory=block_ip_)
+    block_bad_ip: block_bad_ip_ = Field(default_factory=block_bad_ip_)
+    block_continent: block_continent_ = Field(default_factory=block_continent_)
+    block_country: block_country_ = Field(default_factory=block_country_)
+    block_asn: block_asn_ = Field(default_factory=block_asn_)
+    block_rdns_hostname: block_rdns_hostname_ = Field(default_factory=block_rdns_hostname_)
+    allow_hosting: allow_hosting_ = Field(default_factory=allow_hosting_)
+    allow_proxy: allow_proxy_ = Field(default_factory=allow_proxy_)
+    exception_ip: exception_ip_ = Field(default_factory=exception_ip_)
+    exception_path: exception_path_ = Field(default_factory=exception_path_)
+    response: response_ = Field(default_factory=response_)
+    cache: cache_ = Field(default_factory=cache_)
+    disable_logging: disable_logging_ = Field(default_factory=disable_logging_)